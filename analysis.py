@@ -1,29 +1,56 @@
 import os
 import re
 import time
+import random
+import asyncio
+from contextlib import nullcontext
 import streamlit as st
-from openai import OpenAI
+from aiolimiter import AsyncLimiter
 import google.generativeai as genai
 from google.generativeai.types import HarmCategory, HarmBlockThreshold
-from database import store_in_database, store_in_vector_db, get_db_connection
-from utils import load_file_content
+from database import Risk, store_in_database, store_in_vector_db, prepare_vector_records, get_db_connection, get_cached_response, store_cached_response
+from utils import load_file_content, content_hash
+from embedding import ollama_client
 from dotenv import load_dotenv
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize OLLAMA and Gemini clients
-ollama_client = OpenAI(
-    base_url='http://localhost:11434/v1',
-    api_key='ollama'
-)
-
 # Load the Gemini API key from the .env file
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 if not GEMINI_API_KEY:
     raise ValueError("GEMINI_API_KEY not found in .env file")
 genai.configure(api_key=GEMINI_API_KEY)
-gemini_model = genai.GenerativeModel(model_name='gemini-2.0-flash')
+OLLAMA_MODEL = 'jimscard/devopd:latest'
+GEMINI_MODEL = 'gemini-2.0-flash'
+gemini_model = genai.GenerativeModel(model_name=GEMINI_MODEL)
+
+# Characters of file content sent per analysis; Gemini takes more context than the
+# local model, but latency and quota use still grow with prompt length
+OLLAMA_MAX_CONTENT_CHARS = 3000
+GEMINI_MAX_CONTENT_CHARS = 16000
+
+# Scan concurrency and per-model request budget (requests per minute)
+# OLLAMA_NUM_PARALLEL=0 means "auto" to the Ollama server; 0 or less would start no workers, so use the default
+_ollama_num_parallel = int(os.getenv("OLLAMA_NUM_PARALLEL", "4"))
+SCAN_CONCURRENCY = _ollama_num_parallel if _ollama_num_parallel > 0 else 4
+MODEL_QPM = {
+    "OLLAMA": int(os.getenv("OLLAMA_QPM", "60")),
+    "Gemini": int(os.getenv("GEMINI_QPM", "20")),
+}
+
+GEMINI_SAFETY_SETTINGS = {
+    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+}
+# Backoff grows 5s, 10s, 20s, 40s (plus jitter), so retries span a full per-minute quota window
+GEMINI_MAX_RETRIES = 5
+
+# Earliest time.monotonic() at which Gemini may be called again. A quota error moves it
+# forward, so every in-flight request backs off together instead of each hitting the quota.
+_gemini_resume_at = 0.0
 
 OWASP_RISKS = {
     "CICD-SEC-1": "Insufficient traffic control mechanisms",
@@ -38,7 +65,37 @@ OWASP_RISKS = {
     "CICD-SEC-10": "Insufficient logging and visibility"
 }
 
-def analyze_with_ollama(content):
+def _cache_key(model, content):
+    return content_hash(model + content)
+
+async def _generate_with_gemini(prompt, limiter=None):
+    """Call Gemini, backing off with jitter on quota errors; re-raises the last error."""
+    global _gemini_resume_at
+    for attempt in range(GEMINI_MAX_RETRIES):
+        delay = _gemini_resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            async with limiter or nullcontext():
+                return await asyncio.to_thread(
+                    gemini_model.generate_content,
+                    prompt,
+                    safety_settings=GEMINI_SAFETY_SETTINGS
+                )
+        except Exception as e:
+            if "quota" not in str(e).lower() or attempt == GEMINI_MAX_RETRIES - 1:
+                raise
+            backoff = min(60, 2 ** attempt * 5) + random.uniform(0, 5)
+            _gemini_resume_at = max(_gemini_resume_at, time.monotonic() + backoff)
+            st.warning(f"Gemini quota limit reached. Backing off {backoff:.0f} seconds before retrying... (Attempt {attempt + 1}/{GEMINI_MAX_RETRIES})")
+
+async def analyze_with_ollama(content, limiter):
+    content = content[:OLLAMA_MAX_CONTENT_CHARS]
+    cache_key = _cache_key(OLLAMA_MODEL, content)
+    cached = get_cached_response(cache_key)
+    if cached is not None:
+        return cached
+
     prompt = f"""You are a DevSecOps security expert. Analyze the following CI/CD configuration file for potential security risks by considering the full context of the pipeline. Follow these steps:
     1. Thoroughly analyze the configuration file content to identify **specific** security risks. Do not assume risks exist unless there is clear evidence in the content.
     2. For each identified risk, explain the reason based on the specific content provided, not generic assumptions.
@@ -47,7 +104,7 @@ def analyze_with_ollama(content):
     5. If no security risks are found after careful analysis, explicitly state: "No vulnerabilities detected in the provided configuration."
 
     Configuration file content:
-    {content[:3000]}
+    {content}
 
     Output format:
     ### Risk: [Risk Name]
@@ -59,16 +116,28 @@ def analyze_with_ollama(content):
     No vulnerabilities detected in the provided configuration.
     """
     try:
-        response = ollama_client.chat.completions.create(
-            model='jimscard/devopd:latest',
-            messages=[{"role": "user", "content": prompt}],
-            temperature=0.3
-        )
-        return response.choices[0].message.content
+        # The shared sync client is offloaded to a worker thread so its connection
+        # pool is reused across scans instead of binding to one event loop.
+        async with limiter:
+            response = await asyncio.to_thread(
+                ollama_client.chat.completions.create,
+                model=OLLAMA_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+                temperature=0.3
+            )
+        analysis = response.choices[0].message.content
+        store_cached_response(cache_key, OLLAMA_MODEL, analysis)
+        return analysis
     except Exception as e:
         return f"Analysis failed: {str(e)}"
 
-def analyze_with_gemini(content):
+async def analyze_with_gemini(content, limiter):
+    content = content[:GEMINI_MAX_CONTENT_CHARS]
+    cache_key = _cache_key(GEMINI_MODEL, content)
+    cached = get_cached_response(cache_key)
+    if cached is not None:
+        return cached
+
     prompt = f"""You are a DevSecOps security expert. Analyze the following project code for security issues by considering the full context of the code. Follow these steps:
     1. Thoroughly analyze the code content to identify **specific** security risks. Do not assume risks exist unless there is clear evidence in the content.
     2. For each identified risk, explain the reason based on the specific content provided, not generic assumptions.
@@ -88,137 +157,208 @@ def analyze_with_gemini(content):
     If no risks are found:
     No vulnerabilities detected in the provided code.
     """
-    max_retries = 3
-    for attempt in range(max_retries):
-        try:
-            response = gemini_model.generate_content(
-                prompt,
-                safety_settings={
-                    HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                    HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-                    HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-                    HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-                }
-            )
-            if response.candidates and response.candidates[0].content:
-                return response.text
-            else:
-                return "No vulnerabilities detected in the provided code."
-        except Exception as e:
-            if "quota" in str(e).lower():
-                if attempt < max_retries - 1:  # Don't sleep on the last attempt
-                    st.warning(f"Gemini quota limit reached. Waiting 60 seconds before retrying... (Attempt {attempt + 1}/{max_retries})")
-                    time.sleep(60)
-                    continue
-                else:
-                    st.error(f"Gemini quota limit reached after {max_retries} attempts. Skipping this file.")
-                    return f"Analysis failed due to quota limit: {str(e)}"
-            else:
-                return f"Analysis failed: {str(e)}"
+    try:
+        response = await _generate_with_gemini(prompt, limiter)
+        if response.candidates and response.candidates[0].content:
+            # .text raises ValueError for candidates without text parts (e.g. safety stops)
+            text = response.text
+            store_cached_response(cache_key, GEMINI_MODEL, text)
+            return text
+        else:
+            return "No vulnerabilities detected in the provided code."
+    except Exception as e:
+        if "quota" in str(e).lower():
+            st.error(f"Gemini quota limit reached after {GEMINI_MAX_RETRIES} attempts. Skipping this file.")
+            return f"Analysis failed due to quota limit: {str(e)}"
+        return f"Analysis failed: {str(e)}"
+
+# Patterns used to parse "### Risk:" blocks out of model output, compiled once
+_RISK_HEADER_RE = re.compile(r'### Risk:')
+_RISK_NAME_RE = re.compile(r'(.+?)\n')
+_SEVERITY_RE = re.compile(r'\*\*Severity\*\*: (Low|Medium|High)')
+_REASON_RE = re.compile(r'\*\*Reason\*\*: (.+?)(?=\n\*\*Suggestion\*\*:|$)', re.DOTALL)
+
+# Risks whose name contains a keyword are dropped unless the content holds one of
+# its evidence tokens. Scanned content is preprocessed to lowercase words separated
+# by single spaces, so "sh " marks "sh" as a whole word.
+_RISK_EVIDENCE = {
+    "registry": ("registry", "image"),
+    "shell": ("script", "sh ", "bash", "command"),
+    "network": ("network", "host", "bridge", "overlay"),
+    "gitlab": ("gitlab", "runner", "token"),
+}
+
+def _iter_risk_blocks(analysis_text):
+    """Yield the text following each "### Risk:" header up to the next one."""
+    block_start = None
+    for match in _RISK_HEADER_RE.finditer(analysis_text):
+        if block_start is not None:
+            yield analysis_text[block_start:match.start()]
+        block_start = match.end()
+    if block_start is not None:
+        yield analysis_text[block_start:]
 
 def detect_owasp_risks(analysis_text, content):
     detected = []
-    risk_blocks = re.split(r'### Risk:', analysis_text)[1:]
-    for block in risk_blocks:
-        risk_name_match = re.search(r'(.+?)\n', block)
-        severity_match = re.search(r'\*\*Severity\*\*: (Low|Medium|High)', block)
-        reason_match = re.search(r'\*\*Reason\*\*: (.+?)(?=\n\*\*Suggestion\*\*:|$)', block, re.DOTALL)
+    evidence = None
+    for block in _iter_risk_blocks(analysis_text):
+        risk_name_match = _RISK_NAME_RE.search(block)
+        severity_match = _SEVERITY_RE.search(block)
+        reason_match = _REASON_RE.search(block)
         
         if risk_name_match and severity_match and reason_match:
             risk_name = risk_name_match.group(1).strip()
             severity = severity_match.group(1)
             reason = reason_match.group(1).strip()
 
-            if "registry" in risk_name.lower() and not re.search(r'registry|image', content, re.IGNORECASE):
-                continue
-            if "shell" in risk_name.lower() and not re.search(r'script|sh\b|bash|command', content, re.IGNORECASE):
-                continue
-            if "network" in risk_name.lower() and not re.search(r'network|host|bridge|overlay', content, re.IGNORECASE):
-                continue
-            if "gitlab" in risk_name.lower() and not re.search(r'gitlab|runner|token', content, re.IGNORECASE):
+            if evidence is None:
+                # One lowercase pass over the content answers every block's keyword checks
+                content_lc = content.lower() + " "
+                evidence = {keyword: any(token in content_lc for token in tokens)
+                            for keyword, tokens in _RISK_EVIDENCE.items()}
+            risk_name_lc = risk_name.lower()
+            if any(keyword in risk_name_lc and not found for keyword, found in evidence.items()):
                 continue
 
-            detected.append({"risk_name": risk_name, "severity": severity})
+            detected.append(Risk(risk_name=risk_name, severity=severity))
     
     return detected
 
-def scan_directory(directory, model_type):
+def _list_directory(path):
+    """Split a directory's entries into files and subdirectories using one scandir pass."""
+    files, subdirs = [], []
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                # Like os.walk, symlinked directories are not descended into
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                else:
+                    files.append(entry.path)
+    except OSError:
+        pass  # Unreadable directories are skipped, as os.walk does
+    return files, subdirs
+
+async def scan_directory(directory, model_type):
     def clean_previous_data():
         with get_db_connection() as conn:
             conn.execute('DELETE FROM scan_results WHERE file_path LIKE ?', (f"{directory}%",))
+            conn.execute('DELETE FROM risk_events WHERE file_path LIKE ?', (f"{directory}%",))
             conn.commit()
     
     clean_previous_data()
-    
+
+    # Discovery feeds a bounded queue so analysis starts before the walk finishes
+    queue = asyncio.Queue(maxsize=256)
+    limiter = AsyncLimiter(MODEL_QPM[model_type], 60)
+    progress_text = st.empty()
+    discovered_files = 0
+    processed_files = 0  # Track the number of files actually processed
     results = []
-    risk_count = {}
+    pending_rows = []
+    # Per-file messages are collected and rendered once, since each Streamlit write is a round-trip
+    scan_log = []
+    failed_files = 0
+    pending_vector_records = []
 
-    files = []
-    for root, _, filenames in os.walk(directory):
-        for file in filenames:
-            file_path = os.path.join(root, file)
-            files.append(file_path)  # Include all files, no filtering
-    
-    if not files:
-        st.error(f"No files found in: {directory}")
-        return [], {}
+    async def discover_files():
+        nonlocal discovered_files
+        try:
+            pending = [directory]
+            while pending:
+                files, subdirs = await asyncio.to_thread(_list_directory, pending.pop())
+                for file_path in files:  # Include all files, no filtering
+                    discovered_files += 1
+                    await queue.put(file_path)
+                pending.extend(reversed(subdirs))
+        finally:
+            for _ in range(SCAN_CONCURRENCY):
+                await queue.put(None)
 
-    progress_bar = st.progress(0)
-    total_files = len(files)
-    processed_files = 0  # Track the number of files actually processed
-    
-    for idx, file_path in enumerate(files):
+    async def analyze_one(file_path):
+        nonlocal failed_files
         try:
-            content = load_file_content(file_path)
+            try:
+                # Reading, charset detection and cleaning are blocking work; keep them off the event loop
+                content = await asyncio.to_thread(load_file_content, file_path)
+            except OSError as e:
+                st.error(f"Cannot read file {file_path}: {str(e)}")
+                return None
             if not content:
-                processed_files += 1  # Increment even if skipped
-                progress_bar.progress(processed_files / total_files)
-                continue
+                return None
+
+            scan_log.append(f"Analyzing: {file_path}")
+
+            if model_type == "OLLAMA":
+                analysis = await analyze_with_ollama(content, limiter)
+            else:
+                analysis = await analyze_with_gemini(content, limiter)
 
-            st.write(f"Analyzing: {file_path}")
-            
-            analysis = analyze_with_ollama(content) if model_type == "OLLAMA" else analyze_with_gemini(content)
-            
             if "Analysis failed" in analysis or "No vulnerabilities detected" in analysis:
-                st.warning(f"Analysis may have failed for {file_path}")
-                processed_files += 1  # Increment even if skipped
-                progress_bar.progress(processed_files / total_files)
-                continue
+                scan_log.append(f"Analysis may have failed for {file_path}")
+                failed_files += 1
+                return None
 
             detected_risks = detect_owasp_risks(analysis, content)
-            for risk in detected_risks:
-                risk_name = risk["risk_name"]
-                severity = risk["severity"]
-                if risk_name not in risk_count:
-                    risk_count[risk_name] = {"Low": 0, "Medium": 0, "High": 0}
-                risk_count[risk_name][severity] += 1
-
-            store_in_database(file_path, content, detected_risks, analysis)
-            store_in_vector_db(file_path, content, analysis, detect_owasp_risks)
+            # Chunking runs off the event loop so it overlaps other files' model calls;
+            # storage is deferred so the whole scan is written in a few batched calls
+            vector_record = await asyncio.to_thread(
+                prepare_vector_records, file_path, content, detected_risks, analysis
+            )
+            pending_rows.append((file_path, content, detected_risks, analysis))
+            pending_vector_records.append(vector_record)
 
-            results.append({
+            return {
                 "file_path": file_path,
                 "risks": detected_risks,
                 "analysis": analysis
-            })
-
-            processed_files += 1
-            progress_bar.progress(processed_files / total_files)
-            time.sleep(1 if model_type == "OLLAMA" else 3)
-            
+            }
         except Exception as e:
             st.error(f"Error processing {file_path}: {str(e)}")
-            processed_files += 1  # Increment even if an error occurs
-            progress_bar.progress(processed_files / total_files)
-            continue
+            return None
+
+    async def worker():
+        nonlocal processed_files
+        while (file_path := await queue.get()) is not None:
+            result = await analyze_one(file_path)
+            if result is not None:
+                results.append(result)
+            processed_files += 1  # Increment even if skipped or failed
+            progress_text.text(f"Processed {processed_files} of {discovered_files} files found so far")
+
+    # SCAN_CONCURRENCY workers bound the number of in-flight model requests
+    await asyncio.gather(discover_files(), *(worker() for _ in range(SCAN_CONCURRENCY)))
+
+    if not discovered_files:
+        progress_text.empty()
+        st.error(f"No files found in: {directory}")
+        return [], {}
+
+    if pending_rows:
+        store_in_database(pending_rows)
+        store_in_vector_db(pending_vector_records)
+
+    risk_count = {}
+    for result in results:
+        for risk in result["risks"]:
+            risk_name = risk.risk_name
+            severity = risk.severity
+            if risk_name not in risk_count:
+                risk_count[risk_name] = {"Low": 0, "Medium": 0, "High": 0}
+            risk_count[risk_name][severity] += 1
 
-    # Ensure the progress bar reaches 100% at the end
-    progress_bar.progress(1.0)
+    progress_text.text(f"Processed {processed_files} files")
+    if failed_files:
+        st.warning(f"Analysis may have failed for {failed_files} files, see the scan log for details")
+    if scan_log:
+        with st.expander("Scan log", expanded=st.session_state.get('debug_mode', False)):
+            st.code("\n".join(scan_log), language=None)
     st.success("Scan completed!")
 
     return results, risk_count
 
-def generate_rag_response(question, context, model_type):
+async def generate_rag_response(question, context, model_type):
     try:
         if not context or not isinstance(context, list) or context[0] == ["no related files found"]:
             return "No related files found in the scan results."
@@ -239,40 +379,25 @@ def generate_rag_response(question, context, model_type):
         If the context is empty, insufficient, or does not match the question, you must respond only with: No related files found in the scan results
         """
         if model_type == "OLLAMA":
-            response = ollama_client.chat.completions.create(
-                model='jimscard/devopd:latest',
+            response = await asyncio.to_thread(
+                ollama_client.chat.completions.create,
+                model=OLLAMA_MODEL,
                 messages=[{"role": "user", "content": prompt}],
                 temperature=0.0,
                 max_tokens=1200
             )
             return response.choices[0].message.content
         else:
-            max_retries = 3
-            for attempt in range(max_retries):
-                try:
-                    response = gemini_model.generate_content(
-                        prompt,
-                        safety_settings={
-                            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE,
-                            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-                            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-                            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-                        }
-                    )
-                    if response.candidates and response.candidates[0].content:
-                        return response.text
-                    else:
-                        return "No response generated by Gemini. Please try again later."
-                except Exception as e:
-                    if "quota" in str(e).lower():
-                        if attempt < max_retries - 1:
-                            st.warning(f"Gemini quota limit reached in RAG response. Waiting 60 seconds before retrying... (Attempt {attempt + 1}/{max_retries})")
-                            time.sleep(60)
-                            continue
-                        else:
-                            st.error(f"Gemini quota limit reached after {max_retries} attempts in RAG response.")
-                            return f"Response generation failed due to quota limit: {str(e)}"
-                    else:
-                        return f"Response generation failed: {str(e)}"
+            try:
+                response = await _generate_with_gemini(prompt)
+            except Exception as e:
+                if "quota" in str(e).lower():
+                    st.error(f"Gemini quota limit reached after {GEMINI_MAX_RETRIES} attempts in RAG response.")
+                    return f"Response generation failed due to quota limit: {str(e)}"
+                return f"Response generation failed: {str(e)}"
+            if response.candidates and response.candidates[0].content:
+                return response.text
+            else:
+                return "No response generated by Gemini. Please try again later."
     except Exception as e:
         return f"Response generation failed: {str(e)}"
\ No newline at end of file
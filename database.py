@@ -2,25 +2,99 @@ import sqlite3
 import chromadb
 import streamlit as st
 from embedding import OllamaEmbeddingFunction
+from utils import chunk_offsets, content_hash
 import os
 import re
+import threading
+from contextlib import contextmanager
+import msgspec
+from typing import Literal
+
+class Risk(msgspec.Struct):
+    """A single risk detected in a scanned file."""
+    risk_name: str
+    severity: Literal["Low", "Medium", "High"]
+
+_RISKS_DECODER = msgspec.json.Decoder(list[Risk])
+
+def encode_risks(risks):
+    return msgspec.json.encode(risks).decode()
+
+def decode_risks(raw):
+    return _RISKS_DECODER.decode(raw)
+
+def debug_write(*args):
+    """st.write only in debug mode; every write is a websocket round-trip to the browser."""
+    if st.session_state.get('debug_mode', False):
+        st.write(*args)
+
+@st.cache_resource
+def get_chroma_resources():
+    """Create the ChromaDB client and embedding function once per server process."""
+    return chromadb.PersistentClient(path="chroma_db"), OllamaEmbeddingFunction()
 
 # Initialize ChromaDB (can remain global as it's thread-safe)
-chroma_client = chromadb.PersistentClient(path="chroma_db")
+chroma_client, _EMBED = get_chroma_resources()
 collection = chroma_client.get_or_create_collection(
     name="cicd_docs",
-    embedding_function=OllamaEmbeddingFunction()
+    embedding_function=_EMBED
 )
 
+_thread_local = threading.local()
+
 def get_db_connection():
-    """Create or return a new SQLite connection for the current thread."""
-    return sqlite3.connect('cicd_scan.db', check_same_thread=False)
+    """Return the SQLite connection for the current thread, opening it on first use."""
+    conn = getattr(_thread_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect('cicd_scan.db', check_same_thread=False)
+        # WAL lets the UI read while a scan writes, and NORMAL sync skips the fsync per commit
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA temp_store=MEMORY')
+        conn.execute('PRAGMA cache_size=-64000')
+        conn.execute('PRAGMA mmap_size=268435456')
+        _thread_local.conn = conn
+    return conn
+
+@contextmanager
+def transaction():
+    """Group writes into a single transaction that commits on exit and rolls back on error."""
+    conn = get_db_connection()
+    with conn:
+        yield conn
+
+def _recreate_collection():
+    """Drop and recreate the vector collection instead of deleting its ids one by one."""
+    global collection
+    try:
+        chroma_client.delete_collection("cicd_docs")
+    except:
+        pass
+    collection = chroma_client.get_or_create_collection(
+        name="cicd_docs",
+        embedding_function=_EMBED
+    )
+
+def _create_risk_events_table(conn):
+    """One row per detected risk, so the dashboard counts can be aggregated in SQL."""
+    conn.execute('''CREATE TABLE IF NOT EXISTS risk_events
+                 (file_path TEXT,
+                  risk_name TEXT,
+                  severity TEXT)''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_risk_events_name_severity ON risk_events (risk_name, severity)')
 
 def reset_databases(force_reset=False):
     """Reset SQLite and ChromaDB only if forced or initial run."""
-    global collection
+    with get_db_connection() as conn:
+        # The LLM response cache is keyed by content hash and survives resets
+        conn.execute('''CREATE TABLE IF NOT EXISTS llm_cache
+                     (hash TEXT PRIMARY KEY,
+                      model TEXT,
+                      response TEXT)''')
+        conn.commit()
+
     if force_reset:
-        st.write("Resetting databases...")
+        debug_write("Resetting databases...")
         with get_db_connection() as conn:
             conn.execute('DROP TABLE IF EXISTS scan_results')
             conn.execute('''CREATE TABLE scan_results
@@ -30,92 +104,141 @@ def reset_databases(force_reset=False):
                           risks TEXT,
                           analysis TEXT,
                           timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)''')
+            conn.execute('DROP TABLE IF EXISTS risk_events')
+            _create_risk_events_table(conn)
             conn.commit()
         
-        try:
-            chroma_client.delete_collection("cicd_docs")
-        except:
-            pass
-        collection = chroma_client.get_or_create_collection(
-            name="cicd_docs",
-            embedding_function=OllamaEmbeddingFunction()
+        _recreate_collection()
+        debug_write("Databases reset completed.")
+
+def store_in_database(rows):
+    """Insert (file_path, content, risks, analysis) rows in one transaction."""
+    with transaction() as conn:
+        conn.executemany('''
+            INSERT INTO scan_results (file_path, content, risks, analysis)
+            VALUES (?, ?, ?, ?)
+        ''', [(file_path, content, encode_risks(risks), analysis)
+              for file_path, content, risks, analysis in rows])
+        conn.executemany(
+            'INSERT INTO risk_events (file_path, risk_name, severity) VALUES (?, ?, ?)',
+            [(file_path, risk.risk_name, risk.severity)
+             for file_path, _, risks, _ in rows
+             for risk in risks]
         )
-        st.write("Databases reset completed.")
 
-def store_in_database(file_path, content, risks, analysis):
+def get_cached_response(cache_key):
+    """Return the cached LLM response for cache_key, or None on a miss."""
+    with get_db_connection() as conn:
+        row = conn.execute('SELECT response FROM llm_cache WHERE hash = ?', (cache_key,)).fetchone()
+    return row[0] if row else None
+
+def store_cached_response(cache_key, model, response):
     with get_db_connection() as conn:
         conn.execute('''
-            INSERT INTO scan_results (file_path, content, risks, analysis)
-            VALUES (?, ?, ?, ?)
-        ''', (file_path, content, str(risks), analysis))
+            INSERT OR REPLACE INTO llm_cache (hash, model, response)
+            VALUES (?, ?, ?)
+        ''', (cache_key, model, response))
         conn.commit()
 
-def store_in_vector_db(file_path, content, analysis, detect_owasp_risks_func):
+# Upper bound on documents per collection.add, which is also one embedding request
+VECTOR_BATCH_SIZE = 256
+
+def prepare_vector_records(file_path, content, risks, analysis):
+    """Build one file's chunk and summary documents; makes no Streamlit calls, so it can run in a worker thread."""
+    normalized_path = file_path.replace('\\', '/')
+    metadata_base = {
+        "file_path": file_path,
+        "filename": os.path.basename(file_path).lower(),
+        "directory": os.path.dirname(file_path),
+        "risks": encode_risks(risks),
+        "content_type": "cicd_config",
+        # The summary document embeds the analysis, so both feed the hash
+        "content_sha": content_hash(content + analysis)
+    }
+
+    documents = []
+    metadatas = []
+    ids = []
+
+    for i, (start, end) in enumerate(chunk_offsets(content)):
+        chunk_id = f"{normalized_path}_chunk_{i}"
+        chunk_metadata = metadata_base.copy()
+        chunk_metadata["chunk_id"] = i
+        documents.append(content[start:end])
+        metadatas.append(chunk_metadata)
+        ids.append(chunk_id)
+
+    summary_doc = f"""
+    [File Path] {file_path}
+    [Filename] {metadata_base['filename']}
+    [Content Summary] {content[:2000]}
+    [Risk Analysis] {analysis[:1000]}
+    """
+    documents.append(summary_doc)
+    metadatas.append(metadata_base)
+    ids.append(normalized_path)
+    return {
+        "file_path": file_path,
+        "content_sha": metadata_base["content_sha"],
+        "documents": documents,
+        "metadatas": metadatas,
+        "ids": ids
+    }
+
+def store_in_vector_db(records):
+    """Embed and store records from prepare_vector_records in as few round-trips as possible."""
+    if not records:
+        return
     try:
-        normalized_path = file_path.replace('\\', '/')
-        st.write(f"Normalized path: {normalized_path}")
-        existing_ids = collection.get()['ids']
-        st.write(f"Existing IDs before deletion: {existing_ids}")
-        to_delete = [id for id in existing_ids if id.startswith(normalized_path)]
-        if to_delete:
-            collection.delete(ids=to_delete)
-            st.write(f"Deleted IDs: {to_delete}")
-
-        metadata_base = {
-            "file_path": file_path,
-            "filename": os.path.basename(file_path).lower(),
-            "directory": os.path.dirname(file_path),
-            "risks": str(detect_owasp_risks_func(analysis, content)),
-            "content_type": "cicd_config"
-        }
-
-        from utils import chunk_text
-        chunks = chunk_text(content)
+        # Every chunk and the summary carry file_path metadata, so only these files' entries are touched
+        existing = collection.get(
+            where={"file_path": {"$in": [record["file_path"] for record in records]}},
+            include=["metadatas"]
+        )
+        stored_hashes = {meta["file_path"]: meta.get("content_sha") for meta in existing["metadatas"]}
+        changed = [record for record in records
+                   if stored_hashes.get(record["file_path"]) != record["content_sha"]]
+        if not changed:
+            debug_write("Vector data is already up to date.")
+            return
+        collection.delete(where={"file_path": {"$in": [record["file_path"] for record in changed]}})
+
         documents = []
         metadatas = []
         ids = []
+        for record in changed:
+            documents.extend(record["documents"])
+            metadatas.extend(record["metadatas"])
+            ids.extend(record["ids"])
 
-        for i, chunk in enumerate(chunks):
-            chunk_id = f"{normalized_path}_chunk_{i}"
-            chunk_metadata = metadata_base.copy()
-            chunk_metadata["chunk_id"] = i
-            documents.append(chunk)
-            metadatas.append(chunk_metadata)
-            ids.append(chunk_id)
-
-        summary_doc = f"""
-        [File Path] {file_path}
-        [Filename] {metadata_base['filename']}
-        [Content Summary] {content[:2000]}
-        [Risk Analysis] {analysis[:1000]}
-        """
-        documents.append(summary_doc)
-        metadatas.append(metadata_base)
-        ids.append(normalized_path)
-
-        st.write(f"Adding to ChromaDB: {ids}")
-        collection.add(
-            documents=documents,
-            metadatas=metadatas,
-            ids=ids
-        )
-        st.success(f"Successfully stored data for {file_path}")
-        
-        stored_ids = collection.get()['ids']
-        st.write(f"Stored IDs after addition: {stored_ids}")
+        debug_write(f"Adding {len(ids)} documents to ChromaDB")
+        for start in range(0, len(ids), VECTOR_BATCH_SIZE):
+            end = start + VECTOR_BATCH_SIZE
+            collection.add(
+                documents=documents[start:end],
+                metadatas=metadatas[start:end],
+                ids=ids[start:end]
+            )
+        debug_write(f"Successfully stored vector data for {len(changed)} files")
     except Exception as e:
         st.error(f"Vector storage failed: {str(e)}")
-        raise
 
-def query_vectors(question):
+def prewarm_embeddings():
+    """Embed a throwaway text so OLLAMA loads the model before the first real query."""
+    _EMBED(["warmup"])
+
+def embed_query(question):
+    """Embed a single question so callers can reuse it across several queries."""
+    return _EMBED([question])[0]
+
+def query_vectors(question, query_embedding=None):
     try:
-        from embedding import OllamaEmbeddingFunction
         # Match any filename, with or without an extension
         filename_match = re.search(r'\b(\w+(?:\.\w+)?)\b', question, re.IGNORECASE)
         target_filename = filename_match.group(1).lower() if filename_match else None
 
-        embedding_func = OllamaEmbeddingFunction()
-        query_embedding = embedding_func([question])[0]
+        if query_embedding is None:
+            query_embedding = embed_query(question)
         results = collection.query(
             query_embeddings=[query_embedding],
             n_results=5,
@@ -124,7 +247,7 @@ def query_vectors(question):
         
         if results['documents'] and results['metadatas']:
             filtered_docs = []
-            st.write("Query results metadata:", results['metadatas'][0])  # Debug output
+            debug_write("Query results metadata:", results['metadatas'][0])
             for doc, meta in zip(results['documents'][0], results['metadatas'][0]):
                 stored_filename = meta.get('filename', '').lower()
                 if target_filename:
@@ -145,42 +268,31 @@ def query_vectors(question):
 def clean_database():
     with get_db_connection() as conn:
         conn.execute('DELETE FROM scan_results')
+        conn.execute('DELETE FROM risk_events')
         conn.commit()
     try:
-        existing_ids = collection.get()['ids']
-        if existing_ids:
-            collection.delete(ids=existing_ids)
-        else:
-            st.info("No vector data to clean.")
+        _recreate_collection()
     except Exception as e:
         st.error(f"Failed to clean vector database: {str(e)}")
 
 def load_scan_results_from_db():
     with get_db_connection() as conn:
-        query = "SELECT file_path, content, risks, analysis FROM scan_results"
-        import pandas as pd
-        df = pd.read_sql_query(query, conn)
-        results = []
-        for _, row in df.iterrows():
-            results.append({
-                "file_path": row['file_path'],
-                "risks": eval(row['risks']),
-                "analysis": row['analysis']
-            })
-        return results
+        query = "SELECT file_path, risks, analysis FROM scan_results"
+        return [
+            {
+                "file_path": file_path,
+                "risks": decode_risks(risks),
+                "analysis": analysis
+            }
+            for file_path, risks, analysis in conn.execute(query).fetchall()
+        ]
 
 def load_risk_count_from_db():
     with get_db_connection() as conn:
-        query = "SELECT risks FROM scan_results"
-        import pandas as pd
-        df = pd.read_sql_query(query, conn)
+        query = "SELECT risk_name, severity, COUNT(*) FROM risk_events GROUP BY risk_name, severity"
         risk_count = {}
-        for _, row in df.iterrows():
-            detected_risks = eval(row['risks'])
-            for risk in detected_risks:
-                risk_name = risk["risk_name"]
-                severity = risk["severity"]
-                if risk_name not in risk_count:
-                    risk_count[risk_name] = {"Low": 0, "Medium": 0, "High": 0}
-                risk_count[risk_name][severity] += 1
+        for risk_name, severity, count in conn.execute(query).fetchall():
+            if risk_name not in risk_count:
+                risk_count[risk_name] = {"Low": 0, "Medium": 0, "High": 0}
+            risk_count[risk_name][severity] = count
         return risk_count
\ No newline at end of file
@@ -1,15 +1,27 @@
+import os
 from openai import OpenAI
 import numpy as np
 from chromadb.api.types import Documents, EmbeddingFunction, Embeddings  # Add Embeddings to the import
 import streamlit as st
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# nomic-embed-text is Matryoshka-trained, so its leading dimensions can be kept on
+# their own (e.g. 256 of 768) to shrink stored vectors; unset keeps full vectors
+EMBEDDING_DIMENSIONS = int(os.getenv("OLLAMA_EMBED_DIM", "0")) or None
+
+# Shared OLLAMA client so every caller reuses one HTTP connection pool
+ollama_client = OpenAI(
+    base_url='http://localhost:11434/v1',
+    api_key='ollama'
+)
 
 class OllamaEmbeddingFunction(EmbeddingFunction):
-    def __init__(self, model_name="nomic-embed-text"):
-        self.client = OpenAI(
-            base_url='http://localhost:11434/v1',
-            api_key='ollama'
-        )
+    def __init__(self, model_name="nomic-embed-text", client=None, dimensions=EMBEDDING_DIMENSIONS):
+        self.client = client or ollama_client
         self.model_name = model_name
+        self.dimensions = dimensions
 
     def __call__(self, input: Documents) -> Embeddings:
         try:
@@ -17,16 +29,14 @@ class OllamaEmbeddingFunction(EmbeddingFunction):
                 model=self.model_name,
                 input=input
             )
-            embeddings = [item.embedding for item in response.data]
-            embeddings = [self._normalize_embedding(emb) for emb in embeddings]
-            return embeddings
+            # L2-normalize the whole batch in one vectorized pass; zero vectors are left as-is
+            embeddings = np.asarray([item.embedding for item in response.data], dtype=np.float32)
+            if self.dimensions:
+                # Truncate before normalizing so the kept prefix is unit length
+                embeddings = embeddings[:, :self.dimensions]
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings /= np.where(norms == 0, 1.0, norms)
+            return embeddings.tolist()
         except Exception as e:
             st.error(f"Embedding generation failed: {str(e)}")
-            return [[] for _ in input]
-
-    def _normalize_embedding(self, embedding):
-        embedding_array = np.array(embedding)
-        norm = np.linalg.norm(embedding_array)
-        if norm == 0:
-            return embedding_array.tolist()
-        return (embedding_array / norm).tolist()
\ No newline at end of file
+            return [[] for _ in input]
\ No newline at end of file
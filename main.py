@@ -1,6 +1,7 @@
 import os
+import asyncio
 import streamlit as st
-from database import reset_databases, load_scan_results_from_db, load_risk_count_from_db, clean_database
+from database import reset_databases, prewarm_embeddings, load_scan_results_from_db, load_risk_count_from_db, clean_database
 from analysis import scan_directory, generate_rag_response
 from ui import show_analysis_ui, show_rag_qa, show_risk_dashboard
 
@@ -9,6 +10,7 @@ def main():
 
     if 'db_initialized' not in st.session_state:
         reset_databases(force_reset=True)
+        prewarm_embeddings()
         st.session_state.db_initialized = True
 
     if 'scan_results' not in st.session_state or st.session_state.scan_results == []:
@@ -32,7 +34,7 @@ def main():
                     st.session_state.show_confirm = True
                 else:
                     with st.spinner("Scanning in progress..."):
-                        results, risks = scan_directory(scan_dir, st.session_state.model_type)
+                        results, risks = asyncio.run(scan_directory(scan_dir, st.session_state.model_type))
                         st.session_state.scan_results = results
                         st.session_state.risk_count = risks
                     st.success("Scan completed!")
@@ -50,7 +52,7 @@ def main():
                     st.session_state.show_confirm = False
                     st.success("Previous scan results cleared!")
                     with st.spinner("Scanning in progress..."):
-                        results, risks = scan_directory(scan_dir, st.session_state.model_type)
+                        results, risks = asyncio.run(scan_directory(scan_dir, st.session_state.model_type))
                         st.session_state.scan_results = results
                         st.session_state.risk_count = risks
                     st.success("Scan completed!")
@@ -59,7 +61,7 @@ def main():
                     st.session_state.show_confirm = False
                     st.info("Previous scan results retained.")
                     with st.spinner("Scanning in progress..."):
-                        results, risks = scan_directory(scan_dir, st.session_state.model_type)
+                        results, risks = asyncio.run(scan_directory(scan_dir, st.session_state.model_type))
                         st.session_state.scan_results = results
                         st.session_state.risk_count = risks
                     st.success("Scan completed!")
@@ -1,7 +1,8 @@
+import asyncio
 import streamlit as st
 import pandas as pd
 import plotly.express as px
-from database import query_vectors, get_db_connection  # Added get_db_connection
+from database import query_vectors, embed_query, decode_risks, get_db_connection  # Added get_db_connection
 
 def show_analysis_ui():
     st.subheader("File Analysis Results")
@@ -17,13 +18,14 @@ def show_analysis_ui():
         '''
         params = (f"%{search_query}%", f"%{search_query}%")
         
-        df = pd.read_sql_query(query, conn, params=params)
+        rows = conn.execute(query, params).fetchall()
         
-        if not df.empty:
-            for _, row in df.iterrows():
-                with st.expander(row['file_path']):
-                    st.markdown(f"**Detected risks**: {eval(row['risks'])}")
-                    st.markdown(f"**Analysis results**:\n{row['analysis']}")
+        if rows:
+            for file_path, risks, analysis in rows:
+                with st.expander(file_path):
+                    detected = ", ".join(f"{risk.risk_name} ({risk.severity})" for risk in decode_risks(risks))
+                    st.markdown(f"**Detected risks**: {detected}")
+                    st.markdown(f"**Analysis results**:\n{analysis}")
         else:
             st.info("No matching results found")
 
@@ -33,20 +35,23 @@ def show_rag_qa(generate_rag_response_func, model_type):
     
     if question:
         if st.session_state.get('debug_mode', False):
+            # Embed the question once and reuse it for both lookups
+            query_embedding = embed_query(question)
+            context = query_vectors(question, query_embedding)
             with st.expander("Debug Information"):
-                context = query_vectors(question)
                 st.write("Original context:", context)
                 try:
                     from database import collection
                     results = collection.query(
-                        query_texts=[question],
+                        query_embeddings=[query_embedding],
                         include=["metadatas"]
                     )
                     st.write("Matched metadata:", results['metadatas'][0])
                 except Exception as e:
                     st.error(f"Metadata query failed: {str(e)}")
-        context = query_vectors(question)
-        answer = generate_rag_response_func(question, context, model_type)
+        else:
+            context = query_vectors(question)
+        answer = asyncio.run(generate_rag_response_func(question, context, model_type))
         
         with st.container(border=True):
             st.markdown(f"**Question**: {question}")
@@ -57,6 +62,47 @@ def show_rag_qa(generate_rag_response_func, model_type):
                 for doc in context[0]:
                     st.markdown(f"- `{doc[:100]}...`")
 
+@st.cache_data(show_spinner=False, max_entries=8)
+def _build_risk_figures(risk_count):
+    """Build the dashboard figures once per distinct risk_count across reruns."""
+    df = pd.DataFrame.from_records(
+        [(risk_name, severity, count)
+         for risk_name, severities in risk_count.items()
+         for severity, count in severities.items()
+         if count > 0],
+        columns=["Risk Name", "Severity", "Count"]
+    )
+    if df.empty:
+        return None
+
+    heatmap_data = df.pivot(index="Risk Name", columns="Severity", values="Count").fillna(0)
+    heatmap_fig = px.imshow(
+        heatmap_data,
+        labels=dict(x="Severity", y="Risk Name", color="Count"),
+        title="Risk Heatmap by Severity",
+        color_continuous_scale="Reds"
+    )
+
+    treemap_fig = px.treemap(
+        df,
+        path=["Risk Name", "Severity"],
+        values="Count",
+        title="Risk Treemap by Severity",
+        color="Severity",
+        color_discrete_map={"Low": "#00CC96", "Medium": "#EF553B", "High": "#FF0000"}
+    )
+
+    scatter_fig = px.scatter(
+        df,
+        x="Risk Name",
+        y="Count",
+        color="Severity",
+        size="Count",
+        title="Risk Scatter Plot by Severity",
+        color_discrete_map={"Low": "#00CC96", "Medium": "#EF553B", "High": "#FF0000"}
+    )
+    return heatmap_fig, treemap_fig, scatter_fig
+
 def show_risk_dashboard(risk_count):
     st.subheader("Risk Distribution Visualization")
     
@@ -64,52 +110,26 @@ def show_risk_dashboard(risk_count):
         st.error("Risk count data is invalid. Expected a dictionary, but got a different type.")
         return
     
-    data = []
+    valid_risk_count = {}
     for risk_name, severities in risk_count.items():
         if not isinstance(severities, dict):
             st.warning(f"Invalid severity data for risk '{risk_name}'. Skipping this risk.")
             continue
-        for severity, count in severities.items():
-            if count > 0:
-                data.append({"Risk Name": risk_name, "Severity": severity, "Count": count})
+        valid_risk_count[risk_name] = severities
     
-    if not data:
+    figures = _build_risk_figures(valid_risk_count)
+    if figures is None:
         st.info("No risks detected.")
         return
     
-    df = pd.DataFrame(data)
-    
+    heatmap_fig, treemap_fig, scatter_fig = figures
     tab1, tab2, tab3 = st.tabs(["Heatmap", "Treemap", "Scatter Plot"])
     
     with tab1:
-        heatmap_data = df.pivot(index="Risk Name", columns="Severity", values="Count").fillna(0)
-        fig = px.imshow(
-            heatmap_data,
-            labels=dict(x="Severity", y="Risk Name", color="Count"),
-            title="Risk Heatmap by Severity",
-            color_continuous_scale="Reds"
-        )
-        st.plotly_chart(fig)
+        st.plotly_chart(heatmap_fig)
     
     with tab2:
-        fig = px.treemap(
-            df,
-            path=["Risk Name", "Severity"],
-            values="Count",
-            title="Risk Treemap by Severity",
-            color="Severity",
-            color_discrete_map={"Low": "#00CC96", "Medium": "#EF553B", "High": "#FF0000"}
-        )
-        st.plotly_chart(fig)
+        st.plotly_chart(treemap_fig)
     
     with tab3:
-        fig = px.scatter(
-            df,
-            x="Risk Name",
-            y="Count",
-            color="Severity",
-            size="Count",
-            title="Risk Scatter Plot by Severity",
-            color_discrete_map={"Low": "#00CC96", "Medium": "#EF553B", "High": "#FF0000"}
-        )
-        st.plotly_chart(fig)
\ No newline at end of file
+        st.plotly_chart(scatter_fig)
\ No newline at end of file
@@ -1,39 +1,250 @@
-import re
-from nltk.tokenize import word_tokenize
-import nltk
-import streamlit as st
+import os
+import codecs
+import hashlib
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+import numpy as np
+from charset_normalizer import from_bytes
 
-nltk.download('punkt', quiet=True)
+class _CleanTable(dict):
+    """str.translate table that lowercases letters, keeps digits and turns everything else into a space."""
+
+    def __missing__(self, codepoint):
+        char = chr(codepoint)
+        lowered = char.lower()
+        # A few non-ASCII characters lowercase to ASCII letters (e.g. the Kelvin sign to 'k')
+        value = ' ' if lowered == char else lowered.translate(self)
+        # Remember the result so repeated non-ASCII characters skip this call
+        self[codepoint] = value
+        return value
+
+_CLEAN_TABLE = _CleanTable({c: c for c in b'abcdefghijklmnopqrstuvwxyz0123456789'})
+_CLEAN_TABLE.update({c: c + 32 for c in b'ABCDEFGHIJKLMNOPQRSTUVWXYZ'})
+
+# Same mapping for pure-ASCII bytes, where bytes.translate avoids decoding first
+_ASCII_CLEAN_TABLE = bytes(_CLEAN_TABLE[c] if c in _CLEAN_TABLE else 32 for c in range(256))
+
+def _normalize_chars(text):
+    return text.translate(_CLEAN_TABLE)
 
 def preprocess_text(text):
-    tokens = word_tokenize(text.lower())
-    cleaned_tokens = [re.sub(r'[^a-z0-9\s]', '', token) for token in tokens]
-    cleaned_text = ' '.join(token for token in cleaned_tokens if token)
-    return cleaned_text
+    return ' '.join(_normalize_chars(text).split())
 
-def load_file_content(file_path):
-    encodings = ['utf-8', 'latin-1', 'gbk', 'utf-16']
+def _preprocess_ascii(raw):
+    """Bulk path for pure-ASCII bytes: one C-level translate, then a vectorized whitespace collapse."""
+    cleaned = np.frombuffer(raw.translate(_ASCII_CLEAN_TABLE), dtype=np.uint8)
+    is_space = cleaned == 32
+    keep = np.ones(len(cleaned), dtype=bool)
+    # Drop every space that directly follows another space
+    keep[1:] = ~(is_space[1:] & is_space[:-1])
+    return cleaned[keep].tobytes().strip().decode('ascii')
+
+def _decode_non_ascii(raw):
+    try:
+        return preprocess_text(raw.decode('utf-8'))
+    except UnicodeDecodeError:
+        pass
+    # Not UTF-8: detect the encoding once, since latin-1 would accept any bytes as mojibake
+    best = from_bytes(raw).best()
+    if best is not None:
+        return preprocess_text(str(best))
+    encodings = ['latin-1', 'gbk', 'utf-16']
     for encoding in encodings:
         try:
-            with open(file_path, 'r', encoding=encoding) as f:
-                content = f.read()
-                return preprocess_text(content)
+            return preprocess_text(raw.decode(encoding))
         except UnicodeDecodeError:
             continue
+    return preprocess_text(raw.decode('utf-8', errors='replace'))
+
+# Preprocessed text of non-ASCII files, keyed by a hash of the raw bytes; bump the version if cleaning changes
+_DISK_CACHE_DIR = os.getenv(
+    "PREPROCESS_CACHE_DIR",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'preprocessed')
+)
+_DISK_CACHE_MAX_BYTES = int(os.getenv("PREPROCESS_CACHE_MAX_MB", "256")) * 1024 * 1024
+_DISK_CACHE_VERSION = 1
+# The directory is pruned on the first write and then every this many writes
+_DISK_CACHE_PRUNE_INTERVAL = 64
+_disk_cache_writes = 0
+
+def _disk_cache_path(raw):
+    digest = hashlib.blake2b(raw, digest_size=16).hexdigest()
+    return os.path.join(_DISK_CACHE_DIR, f"v{_DISK_CACHE_VERSION}-{digest}.txt")
+
+def _prune_disk_cache():
+    """Delete the least recently used cache files until the directory fits under the size cap."""
+    entries = []
+    with os.scandir(_DISK_CACHE_DIR) as it:
+        for entry in it:
+            if entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    # Hits refresh the mtime, so the oldest mtime is the least recently used file
+    for _, size, path in sorted(entries):
+        if total <= _DISK_CACHE_MAX_BYTES:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+
+def _write_disk_cache(cache_path, text):
+    global _disk_cache_writes
+    # Write to a temporary name first so a concurrent reader never sees a partial file
+    tmp_path = f"{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp"
     try:
-        with open(file_path, 'rb') as f:
-            content = f.read().decode('utf-8', errors='replace')
-            return preprocess_text(content)
-    except Exception as e:
-        st.error(f"Cannot read file {file_path}: {str(e)}")
-        return None
+        os.makedirs(_DISK_CACHE_DIR, exist_ok=True)
+        with open(tmp_path, 'w', encoding='ascii') as f:
+            f.write(text)
+        os.replace(tmp_path, cache_path)
+        # Count the write before pruning, so a failing prune is not retried on every write
+        prune = _disk_cache_writes % _DISK_CACHE_PRUNE_INTERVAL == 0
+        _disk_cache_writes += 1
+        if prune:
+            _prune_disk_cache()
+    except OSError:
+        # The cache is only an optimization; a read-only or full disk must not fail the scan
+        pass
+
+def _decode_and_preprocess(raw):
+    # Pure ASCII is cheaper to clean than to load from disk, so only the slow paths are cached
+    if raw.isascii():
+        return _preprocess_ascii(raw)
+    cache_path = _disk_cache_path(raw)
+    try:
+        with open(cache_path, 'r', encoding='ascii') as f:
+            text = f.read()
+    except OSError:
+        text = None
+    except UnicodeDecodeError:
+        # A corrupt entry would otherwise fail this file on every scan; drop it and rebuild below
+        text = None
+        try:
+            os.remove(cache_path)
+        except OSError:
+            pass
+    if text is not None:
+        try:
+            os.utime(cache_path)
+        except OSError:
+            pass  # A read-only cache still serves hits; only the LRU order goes stale
+        return text
+    text = _decode_non_ascii(raw)
+    _write_disk_cache(cache_path, text)
+    return text
+
+# Files above this size are decoded and cleaned block by block instead of read whole
+_STREAM_THRESHOLD = 8 * 1024 * 1024
+_STREAM_BLOCK_SIZE = 64 * 1024
+
+def _stream_preprocess_utf8(f):
+    """Preprocess a UTF-8 stream block by block; raises UnicodeDecodeError if it is not UTF-8."""
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pieces = []
+    # Cleaned fragments of a token that may continue into the next block; only new text is ever cleaned
+    carry = []
+    while True:
+        block = f.read(_STREAM_BLOCK_SIZE)
+        cleaned = _normalize_chars(decoder.decode(block, final=not block))
+        if block and not cleaned:
+            continue  # Only part of a multi-byte character so far
+        tokens = cleaned.split()
+        if carry:
+            if tokens and not cleaned[0].isspace():
+                if block and len(tokens) == 1 and not cleaned[-1].isspace():
+                    # No separator in this block at all, so the token is still open
+                    carry.append(tokens[0])
+                    continue
+                tokens[0] = ''.join(carry) + tokens[0]
+            else:
+                pieces.append(''.join(carry))
+            carry = []
+        # A token touching the end of the block may continue in the next one
+        if block and tokens and not cleaned[-1].isspace():
+            carry.append(tokens.pop())
+        if tokens:
+            pieces.append(' '.join(tokens))
+        if not block:
+            return ' '.join(pieces)
+
+def _read_and_preprocess(file_path, size):
+    if size > _STREAM_THRESHOLD:
+        try:
+            with open(file_path, 'rb') as f:
+                return _stream_preprocess_utf8(f)
+        except UnicodeDecodeError:
+            pass
+    with open(file_path, 'rb') as f:
+        raw = f.read()
+    return _decode_and_preprocess(raw)
+
+# Preprocessed text of recently loaded files, least recently used first, bounded by total characters
+_FILE_CACHE_MAX_CHARS = 64 * 1024 * 1024
+_file_cache = OrderedDict()
+_file_cache_chars = 0
+_file_cache_lock = threading.Lock()
+
+def _get_cached_file(file_path, stat):
+    with _file_cache_lock:
+        entry = _file_cache.get(file_path)
+        # mtime and size must match, so an edited file misses the cache instead of returning stale text
+        if entry is None or entry[0] != (stat.st_mtime_ns, stat.st_size):
+            return None
+        _file_cache.move_to_end(file_path)
+        return entry[1]
+
+def _store_cached_file(file_path, stat, text):
+    global _file_cache_chars
+    with _file_cache_lock:
+        previous = _file_cache.pop(file_path, None)
+        if previous is not None:
+            _file_cache_chars -= len(previous[1])
+        _file_cache[file_path] = ((stat.st_mtime_ns, stat.st_size), text)
+        _file_cache_chars += len(text)
+        while _file_cache_chars > _FILE_CACHE_MAX_CHARS:
+            _, (_, evicted) = _file_cache.popitem(last=False)
+            _file_cache_chars -= len(evicted)
+
+def load_file_content(file_path):
+    """Read and preprocess a file; raises OSError if it cannot be read, leaving reporting to the caller."""
+    stat = os.stat(file_path)
+    # Files large enough to be streamed are never memoized, so the cache cannot pin them whole
+    if stat.st_size > _STREAM_THRESHOLD:
+        return _read_and_preprocess(file_path, stat.st_size)
+    text = _get_cached_file(file_path, stat)
+    if text is None:
+        text = _read_and_preprocess(file_path, stat.st_size)
+        _store_cached_file(file_path, stat, text)
+    return text
+
+# Each (chunk_size, overlap) pair is specialized once and reused by prepare_vector_records and chunk_text
+@lru_cache(maxsize=None)
+def _make_chunker(chunk_size, overlap):
+    step = chunk_size - overlap
+
+    def chunker(text):
+        text_length = len(text)
+        full_chunks = range(0, text_length - chunk_size + 1, step)
+        for start in full_chunks:
+            yield start, start + chunk_size
+        # Only the last few chunks run past the end, so they are clamped here instead of on every chunk
+        for start in range(len(full_chunks) * step, text_length, step):
+            yield start, text_length
+    return chunker
+
+def chunk_offsets(text, chunk_size=1000, overlap=200):
+    """Lazily yield (start, end) pairs for the chunks of text, so callers slice only when they need the string."""
+    return _make_chunker(chunk_size, overlap)(text)
+
+def chunk_text_iter(text, chunk_size=1000, overlap=200):
+    return (text[start:end] for start, end in chunk_offsets(text, chunk_size, overlap))
 
 def chunk_text(text, chunk_size=1000, overlap=200):
-    chunks = []
-    start = 0
-    text_length = len(text)
-    while start < text_length:
-        end = min(start + chunk_size, text_length)
-        chunks.append(text[start:end])
-        start += chunk_size - overlap
-    return chunks
\ No newline at end of file
+    return list(chunk_text_iter(text, chunk_size, overlap))
+
+def content_hash(text):
+    """Stable SHA-256 hex digest used to key caches on file content."""
+    return hashlib.sha256(text.encode()).hexdigest()
\ No newline at end of file